@@ -1,12 +1,11 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
-from tempfile import NamedTemporaryFile, mkdtemp
 
 import h5py
 import numpy as np
 import pytest
-from numpy.lib.recfunctions import unstructured_to_structured as u2s
 
 from ftag import get_mock_file
 from ftag.cuts import Cuts
@@ -16,35 +15,72 @@ from ftag.transform import Transform
 
 np.random.seed(42)
 
+# optionally compress the test datasets, e.g. on CI runners with slow disks
+COMPRESSION = "lzf" if os.environ.get("PYTEST_COMPRESS", "0") == "1" else None
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _no_h5_locks():
+    # the test files are never shared between writers, so HDF5 file locking is not needed
+    with pytest.MonkeyPatch.context() as mp:
+        if "HDF5_USE_FILE_LOCKING" not in os.environ:
+            mp.setenv("HDF5_USE_FILE_LOCKING", "FALSE")
+        yield
+
+
+@pytest.fixture(scope="session")
+def mock_file_factory():
+    cache = {}
+
+    def _get_mock_file(num_jets: int = 1000):
+        if num_jets not in cache:
+            cache[num_jets] = get_mock_file(num_jets=num_jets)
+        return cache[num_jets]
+
+    return _get_mock_file
+
+
+@pytest.fixture(scope="session")
+def mock_file_default(mock_file_factory):
+    return mock_file_factory()
+
+
+def create_chunked_dataset(f: h5py.File, name: str, data: np.ndarray) -> None:
+    # chunk along the jet axis so that each chunk is roughly 1 MB
+    row_size = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+    rows_per_chunk = min(len(data), max(1, 1_000_000 // row_size))
+    f.create_dataset(
+        name,
+        data=data,
+        chunks=(rows_per_chunk, *data.shape[1:]),
+        compression=COMPRESSION,
+        shuffle=COMPRESSION is not None,
+    )
+
 
 # parameterise the test
 @pytest.mark.parametrize("num", [1, 2, 3])
 @pytest.mark.parametrize("length", [200, 301])
 @pytest.mark.parametrize("equal_jets", [True, False])
-def test_H5Reader(num, length, equal_jets):
-    # calculate all possible effective batch sizes, from single file batch sizes and remainders
+def test_H5Reader(num, length, equal_jets, tmp_path_factory):
     batch_size = 100
-    effective_bs_file = batch_size // num
-    remainders = [(length * n) % effective_bs_file for n in range(num + 1)]
-    effective_bs_options = [effective_bs_file * n + r for n in range(num + 1) for r in remainders]
-    effective_bs_options = [x for x in effective_bs_options if x <= batch_size][1:]
 
     # create test files (of different lengths)
     tmpdirs = []
     file_lengths = []
     for i in range(num):
-        fname = NamedTemporaryFile(suffix=".h5", dir=mkdtemp()).name
-        tmpdirs.append(Path(fname).parent)
+        tmpdir = tmp_path_factory.mktemp(f"h5_{i}")
+        tmpdirs.append(tmpdir)
         jets_length = length * (i + 1)
         file_lengths.append(jets_length)
-        with h5py.File(fname, "w") as f:
-            data = i * np.ones((jets_length, 2))
-            data = u2s(data, dtype=[("x", "f4"), ("y", "f4")])
-            f.create_dataset("jets", data=data)
+        with h5py.File(tmpdir / "f.h5", "w") as f:
+            data = np.empty((jets_length,), dtype=[("x", "f4"), ("y", "f4")])
+            data[...] = (i, i)
+            create_chunked_dataset(f, "jets", data)
 
-            data = i * np.ones((jets_length, 40, 2))
-            data = u2s(data, dtype=[("a", "f4"), ("b", "f4")])
-            f.create_dataset("tracks", data=data)
+            data = np.empty((jets_length, 40), dtype=[("a", "f4"), ("b", "f4")])
+            data[...] = (i, i)
+            create_chunked_dataset(f, "tracks", data)
 
     # create a multi-path sample
     sample = Sample([f"{x}/*.h5" for x in tmpdirs], name="test")
@@ -57,14 +93,9 @@ def test_H5Reader(num, length, equal_jets):
     per_file_bs = [int(batch_size * w) for w in weights]
 
     # all combinations of n * per_file_bs[i] + remainders (as original test tried to capture)
-    effective_bs_options = []
-    for i in range(num + 1):
-        for r in range(batch_size):
-            total_bs = sum(per_file_bs)
-            val = i * total_bs + r
-            if 0 < val <= batch_size:
-                effective_bs_options.append(val)
-    effective_bs_options = list(set(effective_bs_options))  # remove duplicates
+    vals = np.arange(num + 1)[:, None] * sum(per_file_bs) + np.arange(batch_size)[None, :]
+    vals = vals[(vals > 0) & (vals <= batch_size)]
+    effective_bs_options = np.unique(vals).tolist()
 
     assert reader.num_jets == total_jets
 
@@ -77,17 +108,14 @@ def test_H5Reader(num, length, equal_jets):
         assert data["tracks"].shape in [(effective_bs, 40) for effective_bs in effective_bs_options]
         assert len(data["tracks"].dtype.names) == 2
         if equal_jets:  # if equal_jets is off, batches won't necessarily have data from all files
-            assert (np.unique(data["jets"]["x"]) == np.array(list(range(num)))).all()
+            counts = np.bincount(data["jets"]["x"].astype(np.int32, copy=False), minlength=num)
+            assert counts.size == num
+            assert np.all(counts > 0)
 
         # check that the tracks are correctly matched to the jets
-        for i in range(num):
-            trk = (data["tracks"]["a"] == i).all(-1)
-            jet = data["jets"]["x"] == i
-            assert (jet == trk).all()
-
-        if num > 1:
-            corr = np.corrcoef(data["jets"]["x"], data["tracks"]["a"][:, 0])
-            np.testing.assert_allclose(corr, 1)
+        tracks_a = data["tracks"]["a"]
+        assert np.all(tracks_a == tracks_a[:, :1])
+        assert np.all(tracks_a[:, 0] == data["jets"]["x"])
 
     # testing load method
     loaded_data = reader.load(num_jets=-1)
@@ -102,12 +130,17 @@ def test_H5Reader(num, length, equal_jets):
 
 
 @pytest.mark.parametrize("batch_size", [10_000, 11_001, 50_123, 101_234])
-@pytest.mark.parametrize("num_jets", [100_000, 200_000])
-def test_estimate_available_jets(batch_size, num_jets):
-    fname, _ = get_mock_file(num_jets=num_jets)
+@pytest.mark.parametrize(
+    "num_jets",
+    [
+        pytest.param(100_000, marks=pytest.mark.xdist_group("num_jets_100000")),
+        pytest.param(200_000, marks=pytest.mark.xdist_group("num_jets_200000")),
+    ],
+)
+def test_estimate_available_jets(batch_size, num_jets, mock_file_factory):
+    fname, f = mock_file_factory(num_jets)
     reader = H5Reader(fname, batch_size=batch_size, shuffle=False)
-    with h5py.File(reader.files[0]) as f2:
-        jets = f2["jets"][:]
+    jets = f["jets"][:]
 
     cuts = Cuts.from_list(["pt > 50"])
     estimated_num_jets = reader.estimate_available_jets(cuts, num=100_000)
@@ -121,14 +154,18 @@ def test_estimate_available_jets(batch_size, num_jets):
     assert estimated_num_jets <= actual_num_jets
     assert estimated_num_jets > 0.95 * actual_num_jets
 
+
+def test_estimate_available_jets_deterministic(reader):
     # check that the estimate_available_jets function returns the same
-    # number of jets on subsequent calls
-    assert reader.estimate_available_jets(cuts, num=100_000) == estimated_num_jets
+    # number of jets on subsequent calls, using a subset of the shuffled jets
+    cuts = Cuts.from_list(["HadronConeExclTruthLabelID == 5"])
+    estimated_num_jets = reader.estimate_available_jets(cuts, num=500)
+    assert reader.estimate_available_jets(cuts, num=500) == estimated_num_jets
 
 
 @pytest.mark.parametrize("equal_jets", [True, False])
 @pytest.mark.parametrize("cuts_list", [["x != -1"], ["x != 1"], ["x == -1"]])
-def test_equal_jets_estimate(equal_jets, cuts_list):
+def test_equal_jets_estimate(equal_jets, cuts_list, tmp_path_factory):
     # fix the seed to make the test deterministic
     np.random.seed(42)
 
@@ -139,24 +176,22 @@ def test_equal_jets_estimate(equal_jets, cuts_list):
     tmpdirs = []
     actual_available_jets = []
     for i in range(1, total_files + 1):
-        fname = NamedTemporaryFile(suffix=".h5", dir=mkdtemp()).name
-        tmpdirs.append(Path(fname).parent)
-
-        with h5py.File(fname, "w") as f:
-            permutation = np.random.permutation(length * i)
-
-            data = i * np.ones((length * i, 2))
-            data[(length // 2) :, :] = i + 10
-            data = data[permutation]
-            x = data[:, 0]
-            data = u2s(data, dtype=[("x", "f4"), ("y", "f4")])
-            f.create_dataset("jets", data=data)
-
-            data = i * np.ones((length * i, 40, 2))
-            data[(length // 2) :, :, :] = i + 10
-            data = data[permutation]
-            data = u2s(data, dtype=[("a", "f4"), ("b", "f4")])
-            f.create_dataset("tracks", data=data)
+        tmpdir = tmp_path_factory.mktemp(f"h5_{i}")
+        tmpdirs.append(tmpdir)
+
+        with h5py.File(tmpdir / "f.h5", "w") as f:
+            jets = np.empty((length * i,), dtype=[("x", "f4"), ("y", "f4")])
+            jets[: length // 2] = (i, i)
+            jets[length // 2 :] = (i + 10, i + 10)
+            np.random.shuffle(jets)
+            x = jets["x"]
+            create_chunked_dataset(f, "jets", jets)
+
+            # tracks mirror their (already shuffled) jet, so no second permutation is needed
+            tracks = np.empty((length * i, 40), dtype=[("a", "f4"), ("b", "f4")])
+            tracks["a"] = jets["x"][:, None]
+            tracks["b"] = jets["y"][:, None]
+            create_chunked_dataset(f, "tracks", tracks)
 
             # record how many jets would remain after cuts
             cut_condition = eval(cuts_list[0])
@@ -183,8 +218,8 @@ def test_equal_jets_estimate(equal_jets, cuts_list):
     assert estimated_num_jets - actual_available_jets <= 1000
 
 
-def test_reader_transform():
-    fname, _ = get_mock_file()
+def test_reader_transform(mock_file_default):
+    fname, _ = mock_file_default
 
     transform = Transform({
         "jets": {
@@ -200,14 +235,14 @@ def test_reader_transform():
 
 
 @pytest.fixture
-def singlereader():
-    fname, _ = get_mock_file()
+def singlereader(mock_file_default):
+    fname, _ = mock_file_default
     return H5SingleReader(fname, batch_size=10, do_remove_inf=True)
 
 
 @pytest.fixture
-def reader():
-    fname, _ = get_mock_file()
+def reader(mock_file_default):
+    fname, _ = mock_file_default
     return H5Reader(fname, batch_size=10)
 
 
@@ -216,24 +251,27 @@ def test_remove_inf_no_inf_values(singlereader):
     assert (singlereader.remove_inf(data)["jets"] == data["jets"]).all()
 
 
-def test_remove_inf_with_inf_values(singlereader):
-    _, f = get_mock_file()
-    data = {"jets": f["jets"][:100], "tracks": f["tracks"][:100]}
+def test_remove_inf_with_inf_values(singlereader, mock_file_default):
+    _, f = mock_file_default
+    jets = np.empty(100, dtype=f["jets"].dtype)
+    tracks = np.empty((100, *f["tracks"].shape[1:]), dtype=f["tracks"].dtype)
+    f["jets"].read_direct(jets, np.s_[:100])
+    f["tracks"].read_direct(tracks, np.s_[:100])
+
+    data = {"jets": jets.copy(), "tracks": tracks.copy()}
     data["jets"]["pt"] = np.inf
     result = singlereader.remove_inf(data)
     assert len(result["jets"]) == 0
     assert len(result["tracks"]) == 0
 
-    _, f = get_mock_file()
-    data = {"jets": f["jets"][:100], "tracks": f["tracks"][:100]}
+    data = {"jets": jets.copy(), "tracks": tracks.copy()}
     data["jets"]["pt"] = 1
     data["jets"]["pt"][0] = np.inf
     result = singlereader.remove_inf(data)
     assert len(result["jets"]) == 99
     assert len(result["tracks"]) == 99
 
-    _, f = get_mock_file()
-    data = {"jets": f["jets"][:100], "tracks": f["tracks"][:100]}
+    data = {"jets": jets.copy(), "tracks": tracks.copy()}
     data["tracks"]["d0"] = 1
     data["tracks"]["d0"][0] = np.inf
     result = singlereader.remove_inf(data)
@@ -262,9 +300,9 @@ def test_reader_shapes(reader):
     assert reader.shapes(10, ["jets"]) == {"jets": (10,)}
 
 
-def test_reader_dtypes(reader):
-    with h5py.File(reader.files[0]) as f:
-        expected_dtype = {"jets": f["jets"].dtype, "tracks": f["tracks"].dtype}
+def test_reader_dtypes(reader, mock_file_default):
+    _, f = mock_file_default
+    expected_dtype = {"jets": f["jets"].dtype, "tracks": f["tracks"].dtype}
     assert reader.dtypes() == expected_dtype
     print(reader.dtypes({"jets": ["pt"]}))
 
@@ -293,7 +331,7 @@ def test_weighting_two_files_100_vs_900(tmp_path):
 
     def write_file(path: Path, jets):
         with h5py.File(path, "w") as f:
-            f.create_dataset("jets", data=jets)
+            create_chunked_dataset(f, "jets", jets)
 
     fpath_100 = tmp_path / "f100.h5"
     fpath_900 = tmp_path / "f900.h5"
@@ -306,16 +344,16 @@ def test_weighting_two_files_100_vs_900(tmp_path):
     expected_weights = [0.1, 0.9]
     np.testing.assert_allclose(reader.weights, expected_weights, rtol=1e-2)
 
-    counts = {0: 0, 1: 0}
+    counts = np.zeros(2, dtype=np.int64)
     total = 0
     for batch in reader.stream({"jets": ["pt", "source"]}):
         srcs = batch["jets"]["source"]
         total += len(srcs)
+        batch_counts = np.bincount(srcs, minlength=2)
         # Correct split per batch
-        assert np.sum(srcs == 0) == 10
-        assert np.sum(srcs == 1) == 90
-        for s in np.unique(srcs):
-            counts[s] += np.sum(srcs == s)
+        assert batch_counts[0] == 10
+        assert batch_counts[1] == 90
+        counts += batch_counts
 
     assert total == 1000
     assert counts[0] + counts[1] == 1000
@@ -335,34 +373,36 @@ def test_skip_batches(tmp_path):
 
     fpath = tmp_path / "skip_test.h5"
     with h5py.File(fpath, "w") as f:
-        f.create_dataset("jets", data=jets)
+        create_chunked_dataset(f, "jets", jets)
 
     reader = H5Reader(fpath, batch_size=batch_size, shuffle=False)
 
     # Skip first 2 batches (i.e., skip jets 0-199)
     skip_batches = 2
-    indices_seen = []
-    for batch in reader.stream({"jets": ["index"]}, skip_batches=skip_batches):
-        indices_seen.extend(batch["jets"]["index"])
+    indices_seen = np.concatenate([
+        batch["jets"]["index"]
+        for batch in reader.stream({"jets": ["index"]}, skip_batches=skip_batches)
+    ])
 
     # Check that skipped jets are not in the result
-    assert all(i >= skip_batches * batch_size for i in indices_seen)
-    assert len(indices_seen) == num_jets - skip_batches * batch_size
+    assert np.all(indices_seen >= skip_batches * batch_size)
+    assert indices_seen.size == num_jets - skip_batches * batch_size
     assert indices_seen[0] == skip_batches * batch_size
 
 
-@pytest.fixture
-def h5_files(tmp_path):
+@pytest.fixture(scope="module")
+def h5_files(tmp_path_factory):
     # Create 3 files with different number of jets
     # Total of 10k jets
     num_jets_list = [8000, 1500, 500]
-    file_paths = [tmp_path / f"file_{i}.h5" for i in range(len(num_jets_list))]
+    base = tmp_path_factory.mktemp("h5files")
+    file_paths = [base / f"file_{i}.h5" for i in range(len(num_jets_list))]
     for i, (path, num_jets) in enumerate(zip(file_paths, num_jets_list, strict=False)):
         with h5py.File(path, "w") as f:
-            jets = np.zeros(num_jets, dtype=[("value", "i4"), ("index", "i4")])
+            jets = np.empty(num_jets, dtype=[("value", "i4"), ("index", "i4")])
             jets["value"] = i
-            jets["index"] = np.arange(num_jets)
-            f.create_dataset("jets", data=jets)
+            jets["index"] = np.arange(num_jets, dtype="i4")
+            create_chunked_dataset(f, "jets", jets)
     return file_paths
 
 